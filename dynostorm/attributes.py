@@ -1,3 +1,72 @@
+import json
+import zlib
+from datetime import datetime
+from decimal import Decimal
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from dynostorm import constants
+from dynostorm.coalescing import SingleFlight
+
+
+def serialize_value(value):
+    if value is None:
+        return {'NULL': True}
+    elif isinstance(value, bool):
+        return {'BOOL': value}
+    elif isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return {'N': str(value)}
+    elif isinstance(value, str):
+        return {'S': value}
+    elif isinstance(value, (bytes, bytearray)):
+        return {'B': bytes(value)}
+    elif isinstance(value, (set, frozenset)):
+        return serialize_set(value)
+    elif isinstance(value, dict):
+        return {'M': {str(k): serialize_value(v) for k, v in value.items()}}
+    elif isinstance(value, (list, tuple)):
+        return {'L': [serialize_value(v) for v in value]}
+    raise TypeError(f'Cannot serialize {type(value)} to a DynamoDB value')
+
+
+def serialize_set(value):
+    if not value:
+        return {'NULL': True}
+    elif all(isinstance(v, str) for v in value):
+        return {'SS': sorted(value)}
+    elif all(isinstance(v, (bytes, bytearray)) for v in value):
+        return {'BS': sorted(bytes(v) for v in value)}
+    elif all(isinstance(v, (int, float, Decimal)) and not isinstance(v, bool) for v in value):
+        return {'NS': [str(v) for v in sorted(value)]}
+    raise TypeError('Sets must contain only strings, numbers or binary values')
+
+
+def parse_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return Decimal(value)
+
+
+def deserialize_value(value_dict):
+    value_type, value = list(value_dict.items())[0]
+    if value_type == 'NULL':
+        return None
+    elif value_type == 'N':
+        return parse_number(value)
+    elif value_type == 'NS':
+        return {parse_number(v) for v in value}
+    elif value_type in ('SS', 'BS'):
+        return set(value)
+    elif value_type == 'M':
+        return {k: deserialize_value(v) for k, v in value.items()}
+    elif value_type == 'L':
+        return [deserialize_value(v) for v in value]
+    return value
+
 
 class BaseField:
     logical_key = None
@@ -19,19 +88,35 @@ class SortKey(BaseField):
 
 
 class EntityKey(PartitionKey):
-    def __init__(self, for_entity, *fields, **kwargs):
+    def __init__(self, for_entity, *fields, related_name=None, **kwargs):
         self.for_entity = for_entity
+        self.related_name = related_name
         parse_fn = for_entity.partition_field.parse_fn
         super().__init__(parse_fn, *fields, **kwargs)
 
 
 class EntitySortKey(SortKey):
-    def __init__(self, for_entity, *fields, **kwargs):
+    def __init__(self, for_entity, *fields, related_name=None, **kwargs):
         self.for_entity = for_entity
+        self.related_name = related_name
         parse_fn = for_entity.partition_field.parse_fn
         super().__init__(parse_fn, *fields, **kwargs)
 
 
+class RelatedEntity:
+    """
+    Accessor for the entity referenced by an EntityKey or EntitySortKey,
+    served from prefetched results when available.
+    """
+    def __init__(self, logical_key):
+        self.logical_key = logical_key
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.get_related(self.logical_key)
+
+
 class GlobalSecondaryIndex(BaseField):
     def __init__(self, partition, sort, **kwargs):
         super().__init__(None, **kwargs)
@@ -40,18 +125,166 @@ class GlobalSecondaryIndex(BaseField):
 
 
 class Attribute(BaseField):
-    pass
+    def __init__(self, parse_fn=None, *args, **kwargs):
+        super().__init__(parse_fn, *args, **kwargs)
+
+    def parse(self, value):
+        if self.parse_fn is None:
+            return value
+        return super().parse(value)
+
+    def serialize(self, value):
+        return serialize_value(value)
+
+    def serialize_filter_value(self, value):
+        return self.serialize(value)
+
+    def serialize_key(self, value):
+        # Index key attributes are defined as strings on the table
+        value_type, serialized = list(self.serialize(value).items())[0]
+        if value_type not in ('S', 'N'):
+            raise TypeError(f'Cannot use {type(value)} as an index key value')
+        return serialized
+
+    def deserialize(self, value_dict):
+        value = deserialize_value(value_dict)
+        if value is None:
+            return None
+        return self.parse(value)
+
+
+class BoolAttribute(Attribute):
+    def __init__(self, *args, **kwargs):
+        super().__init__(bool, *args, **kwargs)
+
+    def serialize(self, value):
+        return {'BOOL': bool(value)}
+
+
+class ListAttribute(Attribute):
+    def __init__(self, *args, **kwargs):
+        super().__init__(list, *args, **kwargs)
+
+    def serialize(self, value):
+        return {'L': [serialize_value(v) for v in value]}
+
+    def serialize_filter_value(self, value):
+        return serialize_value(value)
+
+
+class MapAttribute(Attribute):
+    def __init__(self, *args, **kwargs):
+        super().__init__(dict, *args, **kwargs)
+
+    def serialize(self, value):
+        return {'M': {str(k): serialize_value(v) for k, v in value.items()}}
+
+    def serialize_filter_value(self, value):
+        return serialize_value(value)
+
+
+class SetAttribute(Attribute):
+    def __init__(self, *args, **kwargs):
+        super().__init__(set, *args, **kwargs)
+
+    def serialize(self, value):
+        return serialize_set(set(value))
+
+    def serialize_filter_value(self, value):
+        return serialize_value(value)
+
+    def deserialize(self, value_dict):
+        value = super().deserialize(value_dict)
+        if value is None:
+            return set()
+        return value
+
+
+class BinaryAttribute(Attribute):
+    def __init__(self, *args, **kwargs):
+        super().__init__(bytes, *args, **kwargs)
+
+    def serialize(self, value):
+        return {'B': bytes(value)}
+
+
+class DateTimeAttribute(Attribute):
+    def __init__(self, *args, **kwargs):
+        super().__init__(datetime.fromisoformat, *args, **kwargs)
+
+    def serialize(self, value):
+        # Strings pass through so date prefixes work in key conditions and filters
+        if isinstance(value, str):
+            return {'S': value}
+        return {'S': value.isoformat()}
+
+
+class JSONAttribute(Attribute):
+    def __init__(self, *args, **kwargs):
+        super().__init__(json.loads, *args, **kwargs)
+
+    def serialize(self, value):
+        return {'S': json.dumps(value, separators=(',', ':'))}
+
+
+class CompressedAttribute(JSONAttribute):
+    """
+    JSON attribute stored as compressed binary once its encoded size reaches
+    `threshold` bytes. Smaller values are stored as plain JSON strings.
+    """
+    def __init__(self, *args, algorithm='zlib', threshold=1024, level=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if algorithm not in constants.COMPRESSION_HEADERS:
+            raise ValueError(f'Unknown compression algorithm {algorithm}')
+        if algorithm == 'zstd' and zstandard is None:
+            raise ImportError('zstd compression requires the zstandard package')
+
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.level = level
+
+    def compress(self, data):
+        if self.algorithm == 'zstd':
+            level = 3 if self.level is None else self.level
+            return zstandard.ZstdCompressor(level=level).compress(data)
+        level = -1 if self.level is None else self.level
+        return zlib.compress(data, level)
+
+    def decompress(self, data):
+        header, payload = data[:1], data[1:]
+        if header == constants.COMPRESSION_HEADERS['zstd']:
+            if zstandard is None:
+                raise ImportError('zstd compression requires the zstandard package')
+            return zstandard.ZstdDecompressor().decompress(payload)
+        elif header == constants.COMPRESSION_HEADERS['zlib']:
+            return zlib.decompress(payload)
+        raise ValueError(f'Unknown compression header {header!r}')
+
+    def serialize(self, value):
+        serialized = super().serialize(value)
+        data = serialized['S'].encode('utf-8')
+        if len(data) < self.threshold:
+            return serialized
+        header = constants.COMPRESSION_HEADERS[self.algorithm]
+        return {'B': header + self.compress(data)}
+
+    def deserialize(self, value_dict):
+        if 'B' in value_dict:
+            data = self.decompress(bytes(value_dict['B']))
+            return self.parse(data.decode('utf-8'))
+        return super().deserialize(value_dict)
 
 
 class AccessPattern(BaseField):
     for_entity = None
 
-    def __init__(self, *fields, return_collection=None):
+    def __init__(self, *fields, return_collection=None, coalesce=False):
         super().__init__(None)
         self.gsi = None
         self.partition = None
         self.sort = None
         self.return_collection = return_collection
+        self.single_flight = SingleFlight() if coalesce else None
 
         for field in fields:
             if isinstance(field, PartitionKey):
@@ -116,7 +349,7 @@ class AccessPattern(BaseField):
 
         for kwarg_key, kwarg_value in kwargs.items():
             if '__' in kwarg_key:
-                k, dec = kwarg_key.split('__')
+                k, dec = kwarg_key.split('__', 1)
             else:
                 k = kwarg_key
                 dec = None
@@ -126,6 +359,21 @@ class AccessPattern(BaseField):
                 key = partition_key
             elif k == logical_sort_key:
                 key = sort_key
+            elif k in self.for_entity.attributes:
+                # Non-key attributes are pushed down as query filters
+                key = self.for_entity.attributes[k].physical_key
+            else:
+                raise ValueError(
+                    f'Field {k} cannot be used as a filter or key condition for '
+                    f'{self.logical_key} on {self.for_entity}'
+                )
+
+            if k in (logical_partition_key, logical_sort_key):
+                # Key conditions are compared against the stored key strings
+                if constants.OP_MAP.get(dec) in constants.MULTI_VALUE_OPERATORS:
+                    kwarg_value = [self.get_key_key_value(k, v) for v in kwarg_value]
+                else:
+                    kwarg_value = self.get_key_key_value(k, kwarg_value)
 
             if key:
                 if dec:
@@ -134,11 +382,30 @@ class AccessPattern(BaseField):
                     access_kwargs[key] = kwarg_value
         return access_kwargs
 
-    def __call__(self, *args, **kwargs):
+    def count(self, *args, **kwargs):
         access_kwargs = self.get_access_kwargs(*args, **kwargs)
+        return self.for_entity.count(self.gsi, **access_kwargs)
 
-        response = self.for_entity.get(self.gsi, **access_kwargs)
-        items = response.get('Items', [])
+    def __call__(self, *args, **kwargs):
+        access_kwargs = self.get_access_kwargs(*args, **kwargs)
+        if self.single_flight is None:
+            return self.fetch(access_kwargs)
+
+        # Concurrent calls resolving to the same query share one request and
+        # the same decoded result object
+        key = self.single_flight.get_key(
+            self.for_entity.get_query_kwargs(self.gsi, **access_kwargs)
+        )
+        return self.single_flight.do(key, lambda: self.fetch(access_kwargs))
+
+    def coalesce_stats(self):
+        if self.single_flight is None:
+            return None
+        return self.single_flight.stats()
+
+    def fetch(self, access_kwargs):
+        # Filters apply per page, so results are read across all pages
+        items = self.for_entity.get_items(self.gsi, **access_kwargs)
         """
         {
             'Items': [
@@ -178,9 +445,12 @@ class AccessPattern(BaseField):
                 collection.append(self.for_entity.from_response(item))
             return collection
         elif self.return_collection is False:
-            return self.for_entity.from_response(items[0])
+            item = next(items, None)
+            if item is None:
+                return None
+            return self.for_entity.from_response(item)
         else:
-            return items
+            return list(items)
 
 
 class AccessPatternSingle(AccessPattern):
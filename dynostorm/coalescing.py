@@ -0,0 +1,73 @@
+import json
+import threading
+
+
+class CoalescedCallError(Exception):
+    pass
+
+
+class InFlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls sharing a key into a single execution. The
+    first caller runs the function, later callers wait for and share its
+    result. The result object itself is shared, so mutating it is visible
+    to every caller. If the first call fails, waiting callers get a
+    CoalescedCallError chained to the original exception.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.calls = 0
+        self.executed = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def get_key(params):
+        return json.dumps(params, sort_keys=True, default=repr)
+
+    def do(self, key, fn):
+        with self.lock:
+            self.calls += 1
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = InFlightCall()
+                self.in_flight[key] = call
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise CoalescedCallError(
+                    f'Coalesced call failed: {call.error!r}'
+                ) from call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'in_flight': len(self.in_flight),
+            }
@@ -13,3 +13,20 @@ OP_MAP = {
     'in': 'IN',
     'between': 'BETWEEN'
 }
+
+NULL_OPERATORS = ('NULL', 'NOT_NULL')
+
+MULTI_VALUE_OPERATORS = ('IN', 'BETWEEN')
+
+ELEMENT_OPERATORS = ('CONTAINS', 'NOT_CONTAINS')
+
+COMPRESSION_HEADERS = {
+    'zlib': b'\x01',
+    'zstd': b'\x02',
+}
+
+BATCH_GET_LIMIT = 100
+
+BATCH_GET_BACKOFF = 0.05
+
+BATCH_GET_MAX_ATTEMPTS = 8
@@ -1,8 +1,11 @@
+import time
+
 import boto3
 
 from dynostorm import constants
 from dynostorm.attributes import PartitionKey, Attribute, GlobalSecondaryIndex, \
-    AccessPattern, SortKey, BaseField, EntityKey, EntitySortKey
+    AccessPattern, SortKey, BaseField, EntityKey, EntitySortKey, RelatedEntity, \
+    serialize_value
 
 
 class EntityMeta(type):
@@ -33,6 +36,11 @@ class EntityMeta(type):
             elif isinstance(val, GlobalSecondaryIndex):
                 global_secondary_indexes[name] = val
 
+        for name, val in fields.items():
+            related_name = getattr(val, 'related_name', None)
+            if related_name is not None:
+                clsdict[related_name] = RelatedEntity(name)
+
         clsdict['partition_field'] = partition_field
         clsdict['sort_field'] = sort_field
         clsdict['fields'] = fields
@@ -65,6 +73,7 @@ class Entity(metaclass=EntityMeta):
     def __init__(self, **kwargs):
         self._partition_attribute = None
         self._sort_attribute = None
+        self._related = {}
 
         for logical_key, field in self.__class__.fields.items():
             if isinstance(field, PartitionKey):
@@ -87,6 +96,21 @@ class Entity(metaclass=EntityMeta):
             return '$'
         return self.get_field_value(self._sort_attribute.logical_key)
 
+    @classmethod
+    def get_related_field(cls, logical_key):
+        field = cls.fields.get(logical_key)
+        if not isinstance(field, (EntityKey, EntitySortKey)):
+            raise ValueError(f'Field {logical_key} on {cls} is not an entity reference')
+        return field
+
+    def get_related(self, logical_key):
+        if logical_key not in self._related:
+            prefetch([self], logical_key)
+        return self._related[logical_key]
+
+    def set_related(self, logical_key, entity):
+        self._related[logical_key] = entity
+
     def get_field_value(self, logical_key):
         return self.__class__.get_key_value(logical_key, getattr(self, logical_key))
 
@@ -100,6 +124,7 @@ class Entity(metaclass=EntityMeta):
         name_attributes = {}
         value_attributes = {}
         value_map = {}
+        value_fields = {}
         for logical_key, field in self.__class__.attributes.items():
             value = getattr(self, logical_key)
             if value is not None:
@@ -108,16 +133,21 @@ class Entity(metaclass=EntityMeta):
 
                 value_map[set_field_key] = set_value_key
                 value_attributes[set_value_key] = value
+                value_fields[set_value_key] = field
                 name_attributes[set_field_key] = field.logical_key
 
         for gsi_key, gsi in self.__class__.global_secondary_indexes.items():
+            pk_logical_key = gsi.partition.logical_key
+            sk_logical_key = gsi.sort.logical_key
+            if getattr(self, pk_logical_key) is None or getattr(self, sk_logical_key) is None:
+                # Items missing an index key are left out of the index
+                continue
+
             i = self.__class__.table.get_gsi_index(gsi)
             pk_set_key = f':pk{i}'
             sk_set_key = f':sk{i}'
             value_map[f'pk{i}'] = pk_set_key
             value_map[f'sk{i}'] = sk_set_key
-            pk_logical_key = gsi.partition.logical_key
-            sk_logical_key = gsi.sort.logical_key
             value_attributes[pk_set_key] = self.get_field_value(
                 pk_logical_key)
             value_attributes[sk_set_key] = self.get_field_value(
@@ -127,60 +157,89 @@ class Entity(metaclass=EntityMeta):
             'names': name_attributes,
             'values': value_attributes,
             'map': value_map,
+            'fields': value_fields,
         }
 
-    def get_value_type_index(self, value):
-        if isinstance(value, int):
-            return 'N'
-        elif isinstance(value, float):
-            return 'N'
-        elif isinstance(value, str):
-            return 'S'
-        elif isinstance(value, bool):
-            return 'BOOL'
+    @classmethod
+    def get_value_type_index(cls, value):
+        return list(serialize_value(value).keys())[0]
+
+    @classmethod
+    def get_attribute_value(cls, value, field=None):
+        if field is not None:
+            return field.serialize(value)
+        return serialize_value(value)
 
     def save(self):
         keys = self.get_update_keys()
         update_attributes = self.get_update_attributes()
         update_expression = f'set {", ".join([f"{field_key} = {set_key}" for field_key, set_key in update_attributes["map"].items()])}'
         update_expression_values = {
-            set_key: {
-                self.get_value_type_index(value): str(value)
-            } for set_key, value in update_attributes['values'].items()
+            set_key: self.get_attribute_value(
+                value,
+                update_attributes['fields'].get(set_key)
+            ) for set_key, value in update_attributes['values'].items()
         }
         update_expression_names = {
             field_key: field_name for field_key, field_name in update_attributes['names'].items()
         }
 
-        self.__class__.table.client().update_item(
+        update_kwargs = dict(
             TableName=self.__class__.table.table_name,
             Key=keys,
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=update_expression_values,
-            ExpressionAttributeNames=update_expression_names,
         )
+        # DynamoDB rejects empty expressions, e.g. when only keys are set
+        if update_attributes['map']:
+            update_kwargs['UpdateExpression'] = update_expression
+            update_kwargs['ExpressionAttributeValues'] = update_expression_values
+        if update_expression_names:
+            update_kwargs['ExpressionAttributeNames'] = update_expression_names
+
+        self.__class__.table.client().update_item(**update_kwargs)
 
     @classmethod
     def from_response(cls, data):
         kwargs = {}
         for physical_name, value_dict in data.items():
             value_type, value = list(value_dict.items())[0]
-            if physical_name == 'pk':
+            if physical_name in cls.attributes:
+                kwargs[physical_name] = cls.attributes[physical_name].deserialize(
+                    value_dict
+                )
+            elif physical_name == 'pk':
                 entity_type, value = cls.parse_key(value)
                 kwargs[cls.partition_field.logical_key] = cls.parse_physical_value(
                     cls.partition_field.logical_key,
                     value
                 )
-            elif physical_name == 'sk':
+            elif physical_name == 'sk' and cls.sort_field is not None:
                 entity_type, value = cls.parse_key(value)
                 kwargs[cls.sort_field.logical_key] = cls.parse_physical_value(
                     cls.sort_field.logical_key,
                     value
                 )
-            else:
+            elif physical_name in cls.fields:
                 kwargs[physical_name] = cls.parse_physical_value(physical_name, value)
         return cls(**kwargs)
 
+    @classmethod
+    def get_reference_keys(cls, value):
+        if cls.sort_field is not None:
+            raise ValueError(f'{cls} has a sort key and cannot be loaded by reference')
+        return {
+            'pk': {'S': cls.get_key_value(cls.partition_field.logical_key, value)},
+            'sk': {'S': '$'},
+        }
+
+    @classmethod
+    def batch_get(cls, values):
+        keys = [cls.get_reference_keys(value) for value in values]
+        entities = {}
+        for item in cls.table.batch_get(keys):
+            entity = cls.from_response(item)
+            entities[getattr(entity, cls.partition_field.logical_key)] = entity
+        return entities
+
     @classmethod
     def parse_key(cls, key):
         return key.split('#')
@@ -190,30 +249,100 @@ class Entity(metaclass=EntityMeta):
         return f'{cls.__name__}#'
 
     @classmethod
-    def get(cls, gsi=None, **kwargs):
+    def get_filter_condition(cls, field, comparison_operator, value):
+        condition = {'ComparisonOperator': comparison_operator}
+        if comparison_operator in constants.NULL_OPERATORS:
+            return condition
+
+        if comparison_operator in constants.MULTI_VALUE_OPERATORS:
+            values = list(value)
+        else:
+            values = [value]
+
+        if comparison_operator in constants.ELEMENT_OPERATORS:
+            condition['AttributeValueList'] = [serialize_value(v) for v in values]
+        else:
+            condition['AttributeValueList'] = [
+                field.serialize_filter_value(v) for v in values
+            ]
+        return condition
+
+    @classmethod
+    def get_query_kwargs(cls, gsi=None, **kwargs):
         key_conditions = {}
+        query_filter = {}
         for attribute_key, value in kwargs.items():
             comparison_operator = 'EQ'
+            op = None
             if '__' in attribute_key:
-                attribute_key, op = attribute_key.split('__')
+                attribute_key, op = attribute_key.split('__', 1)
                 comparison_operator = constants.OP_MAP.get(op, 'EQ')
 
+            if attribute_key in cls.attributes:
+                if op is not None and op not in constants.OP_MAP:
+                    raise ValueError(f'Unknown filter operator {op} for {attribute_key}')
+                # The legacy QueryFilter holds a single condition per attribute
+                if attribute_key in query_filter:
+                    raise ValueError(f'Attribute {attribute_key} can only be filtered once')
+                query_filter[attribute_key] = cls.get_filter_condition(
+                    cls.attributes[attribute_key],
+                    comparison_operator,
+                    value
+                )
+                continue
+
+            if comparison_operator in constants.MULTI_VALUE_OPERATORS:
+                values = list(value)
+            else:
+                values = [value]
+
             key_conditions[attribute_key] = {
                 'ComparisonOperator': comparison_operator,
-                'AttributeValueList': [
-                    {'S': value}
-                ]
+                'AttributeValueList': [{'S': v} for v in values]
             }
 
         query_kwargs = dict(
             TableName=cls.table.table_name,
             KeyConditions=key_conditions
         )
+        if query_filter:
+            query_kwargs['QueryFilter'] = query_filter
         if gsi is not None:
             query_kwargs['IndexName'] = gsi.logical_key
 
+        return query_kwargs
+
+    @classmethod
+    def get(cls, gsi=None, **kwargs):
+        query_kwargs = cls.get_query_kwargs(gsi, **kwargs)
         return cls.table.client().query(**query_kwargs)
 
+    @classmethod
+    def query_pages(cls, query_kwargs):
+        query_kwargs = dict(query_kwargs)
+        while True:
+            response = cls.table.client().query(**query_kwargs)
+            yield response
+            last_evaluated_key = response.get('LastEvaluatedKey')
+            if not last_evaluated_key:
+                return
+            query_kwargs['ExclusiveStartKey'] = last_evaluated_key
+
+    @classmethod
+    def get_items(cls, gsi=None, **kwargs):
+        query_kwargs = cls.get_query_kwargs(gsi, **kwargs)
+        for response in cls.query_pages(query_kwargs):
+            yield from response.get('Items', [])
+
+    @classmethod
+    def count(cls, gsi=None, **kwargs):
+        query_kwargs = cls.get_query_kwargs(gsi, **kwargs)
+        query_kwargs['Select'] = 'COUNT'
+        return sum(
+            response.get('Count', 0)
+            for response in cls.query_pages(query_kwargs)
+        )
+
     @classmethod
     def get_gsi_key(cls, logical_key, gsi):
         gsi_index = cls.table.get_gsi_index(gsi)
@@ -236,6 +365,8 @@ class Entity(metaclass=EntityMeta):
             return f'{cls.get_key_prefix()}{value}'
         elif isinstance(field, SortKey):
             return f'{cls.get_key_prefix()}{value}'
+        elif isinstance(field, Attribute):
+            return field.serialize_key(value)
 
         return value
 
@@ -245,6 +376,34 @@ class Entity(metaclass=EntityMeta):
         return field.parse(value)
 
 
+def prefetch(items, *logical_keys):
+    """
+    Loads the entities referenced by `logical_keys` on each item with
+    batched BatchGetItem requests and attaches them to the items.
+    """
+    for logical_key in logical_keys:
+        references = {}
+        for item in items:
+            field = item.__class__.get_related_field(logical_key)
+            value = getattr(item, logical_key)
+            if value is not None:
+                # Parse so values match the keys of the loaded entities
+                references.setdefault(field.for_entity, set()).add(field.parse(value))
+
+        loaded = {}
+        for for_entity, values in references.items():
+            loaded[for_entity] = for_entity.batch_get(values)
+
+        for item in items:
+            field = item.__class__.fields[logical_key]
+            value = getattr(item, logical_key)
+            entity = None
+            if value is not None:
+                entity = loaded.get(field.for_entity, {}).get(field.parse(value))
+            item.set_related(logical_key, entity)
+    return items
+
+
 class TableMeta(type):
     def __new__(mcs, clsname, bases, clsdict):
         if clsdict.get('table_name', None) is None:
@@ -271,6 +430,28 @@ class Table(metaclass=TableMeta):
             setattr(cls, '_client', boto3.client('dynamodb', region_name=cls.region_name))
         return getattr(cls, '_client')
 
+    @classmethod
+    def batch_get(cls, keys):
+        items = []
+        keys = list(keys)
+        for i in range(0, len(keys), constants.BATCH_GET_LIMIT):
+            request_items = {
+                cls.table_name: {'Keys': keys[i:i + constants.BATCH_GET_LIMIT]}
+            }
+            attempt = 0
+            while request_items:
+                if attempt >= constants.BATCH_GET_MAX_ATTEMPTS:
+                    raise RuntimeError(
+                        f'BatchGetItem left keys unprocessed after {attempt} attempts'
+                    )
+                if attempt > 0:
+                    time.sleep(min(constants.BATCH_GET_BACKOFF * 2 ** attempt, 1))
+                response = cls.client().batch_get_item(RequestItems=request_items)
+                items.extend(response.get('Responses', {}).get(cls.table_name, []))
+                request_items = response.get('UnprocessedKeys')
+                attempt += 1
+        return items
+
     @classmethod
     def enumerate_gsis(cls):
         gsi_keys = []
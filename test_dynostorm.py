@@ -1,6 +1,19 @@
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
 from dynostorm.attributes import PartitionKey, Attribute, GlobalSecondaryIndex, \
-    AccessPattern, EntityKey, SortKey, AccessPatternMany, EntitySortKey
-from dynostorm.entities import Table
+    AccessPattern, EntityKey, SortKey, AccessPatternMany, AccessPatternSingle, \
+    EntitySortKey, BoolAttribute, ListAttribute, MapAttribute, SetAttribute, \
+    BinaryAttribute, DateTimeAttribute, JSONAttribute, CompressedAttribute, \
+    RelatedEntity
+from dynostorm import constants
+from dynostorm.coalescing import SingleFlight, CoalescedCallError
+from dynostorm.entities import Table, prefetch
 
 
 class TestTable(Table):
@@ -22,6 +35,11 @@ class Bar(TestTable.Entity):
     record_by_id = AccessPattern(id)
 
 
+class Baz(TestTable.Entity):
+    id = PartitionKey(int)
+    baz_by_id = AccessPatternSingle(id, coalesce=True)
+
+
 class TestItem(TestTable.EntityItem):
     test_id = EntityKey(Test)
     id = SortKey(str)
@@ -31,14 +49,35 @@ class TestItem(TestTable.EntityItem):
 
 
 class TestBar(TestTable.EntityItem):
-    test_id = EntityKey(Test)
-    bar_id = EntitySortKey(Bar)
+    test_id = EntityKey(Test, related_name='test')
+    bar_id = EntitySortKey(Bar, related_name='bar')
 
     quantity = Attribute(int)
 
     test_bars_by_test = AccessPatternMany(test_id)
 
 
+class TestEvent(TestTable.Entity):
+    id = PartitionKey(int)
+    happened = DateTimeAttribute()
+
+    gsi2 = GlobalSecondaryIndex(happened, id)
+
+    events_by_time = AccessPatternMany(gsi2)
+
+
+class TestDocument(TestTable.Entity):
+    id = PartitionKey(int)
+    active = BoolAttribute()
+    tags = ListAttribute()
+    meta = MapAttribute()
+    labels = SetAttribute()
+    blob = BinaryAttribute()
+    updated = DateTimeAttribute()
+    payload = JSONAttribute()
+    body = CompressedAttribute(threshold=64)
+
+
 def test_pk_sk_getters():
     test = Test(id=1, date_created='2022-11-24')
     assert test.pk == 'Test#1'
@@ -124,3 +163,435 @@ def test_entity_update_attributes():
     assert update_attributes['names'] == {
         '#quantity': 'quantity'
     }
+
+
+def test_access_pattern_filter_pushdown():
+    assert TestItem.test_items_by_test.get_access_kwargs(1, quantity__gt=5) == {
+        'pk': 'Test#1',
+        'sk__begins_with': 'TestItem#',
+        'quantity__gt': 5
+    }
+
+    access_kwargs = TestItem.test_items_by_test.get_access_kwargs(
+        1,
+        quantity__between=(2, 4)
+    )
+    query_kwargs = TestItem.get_query_kwargs(**access_kwargs)
+    assert query_kwargs['KeyConditions'] == {
+        'pk': {
+            'ComparisonOperator': 'EQ',
+            'AttributeValueList': [{'S': 'Test#1'}]
+        },
+        'sk': {
+            'ComparisonOperator': 'BEGINS_WITH',
+            'AttributeValueList': [{'S': 'TestItem#'}]
+        }
+    }
+    assert query_kwargs['QueryFilter'] == {
+        'quantity': {
+            'ComparisonOperator': 'BETWEEN',
+            'AttributeValueList': [{'N': '2'}, {'N': '4'}]
+        }
+    }
+
+    query_kwargs = TestItem.get_query_kwargs(
+        **TestItem.test_items_by_test.get_access_kwargs(1, quantity__is_null=True)
+    )
+    assert query_kwargs['QueryFilter'] == {
+        'quantity': {'ComparisonOperator': 'NULL'}
+    }
+
+    query_kwargs = TestItem.get_query_kwargs(
+        **TestItem.test_items_by_test.get_access_kwargs(1)
+    )
+    assert 'QueryFilter' not in query_kwargs
+
+
+class FakeClient:
+    """
+    Records client calls. Responses are either a list answered in call order
+    or a function called with the request kwargs.
+    """
+    def __init__(self, **responses):
+        self.responses = responses
+        self.calls = defaultdict(list)
+
+    def __getattr__(self, name):
+        def method(**kwargs):
+            self.calls[name].append(dict(kwargs))
+            response = self.responses.get(name)
+            if callable(response):
+                return response(**kwargs)
+            elif isinstance(response, list):
+                return response[len(self.calls[name]) - 1]
+            return response
+        return method
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    def install(**responses):
+        client = FakeClient(**responses)
+        monkeypatch.setattr(TestTable, '_client', client, raising=False)
+        return client
+    return install
+
+
+def test_access_pattern_count(fake_client):
+    client = fake_client(query=[
+        {'Count': 2, 'LastEvaluatedKey': {'pk': {'S': 'Test#1'}}},
+        {'Count': 3},
+    ])
+    assert TestItem.test_items_by_test.count(1, quantity__gt=5) == 5
+
+    calls = client.calls['query']
+    assert len(calls) == 2
+    assert calls[0]['Select'] == 'COUNT'
+    assert 'ExclusiveStartKey' not in calls[0]
+    assert calls[1]['ExclusiveStartKey'] == {'pk': {'S': 'Test#1'}}
+    assert calls[1]['QueryFilter'] == {
+        'quantity': {
+            'ComparisonOperator': 'GT',
+            'AttributeValueList': [{'N': '5'}]
+        }
+    }
+
+
+def test_value_type_index():
+    assert Test.get_value_type_index(True) == 'BOOL'
+    assert Test.get_value_type_index(1) == 'N'
+    assert Test.get_value_type_index(1.5) == 'N'
+    assert Test.get_value_type_index('1') == 'S'
+    assert Test.get_value_type_index(b'1') == 'B'
+    assert Test.get_value_type_index([1]) == 'L'
+    assert Test.get_value_type_index({'a': 1}) == 'M'
+    assert Test.get_value_type_index({'a'}) == 'SS'
+    assert Test.get_value_type_index({1}) == 'NS'
+
+
+def test_typed_attributes_round_trip():
+    document = TestDocument(
+        id=1,
+        active=False,
+        tags=['a', 1, True],
+        meta={'count': 2, 'nested': {'ok': None}},
+        labels={'b', 'a'},
+        blob=b'\x00\x01',
+        updated=datetime(2022, 11, 25, 18, 37, 11),
+        payload={'a': [1, 2]},
+        body={'text': 'x' * 128},
+    )
+    update_attributes = document.get_update_attributes()
+    values = {
+        set_key: document.get_attribute_value(
+            value,
+            update_attributes['fields'].get(set_key)
+        ) for set_key, value in update_attributes['values'].items()
+    }
+    assert values[':active'] == {'BOOL': False}
+    assert values[':tags'] == {
+        'L': [{'S': 'a'}, {'N': '1'}, {'BOOL': True}]
+    }
+    assert values[':meta'] == {
+        'M': {'count': {'N': '2'}, 'nested': {'M': {'ok': {'NULL': True}}}}
+    }
+    assert values[':labels'] == {'SS': ['a', 'b']}
+    assert values[':blob'] == {'B': b'\x00\x01'}
+    assert values[':updated'] == {'S': '2022-11-25T18:37:11'}
+    assert values[':payload'] == {'S': '{"a":[1,2]}'}
+    assert list(values[':body'].keys()) == ['B']
+    assert len(values[':body']['B']) < 64
+
+    data = {set_key[1:]: value for set_key, value in values.items()}
+    data['pk'] = {'S': 'TestDocument#1'}
+    data['sk'] = {'S': '$'}
+    loaded = TestDocument.from_response(data)
+    assert loaded.id == 1
+    assert loaded.active is False
+    assert loaded.tags == ['a', 1, True]
+    assert loaded.meta == {'count': 2, 'nested': {'ok': None}}
+    assert loaded.labels == {'a', 'b'}
+    assert loaded.blob == b'\x00\x01'
+    assert loaded.updated == datetime(2022, 11, 25, 18, 37, 11)
+    assert loaded.payload == {'a': [1, 2]}
+    assert loaded.body == {'text': 'x' * 128}
+
+
+def test_compressed_attribute_threshold():
+    assert TestDocument.body.serialize({'a': 1}) == {'S': '{"a":1}'}
+    assert TestDocument.body.deserialize({'S': '{"a":1}'}) == {'a': 1}
+
+
+def test_access_pattern_coalescing(fake_client):
+    release = threading.Event()
+
+    def query(**kwargs):
+        release.wait(5)
+        return {'Items': [{
+            'pk': {'S': 'Baz#1'},
+            'sk': {'S': '$'},
+        }]}
+
+    client = fake_client(query=query)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(Baz.baz_by_id(1)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for _ in range(500):
+        if Baz.baz_by_id.coalesce_stats()['coalesced'] == 4:
+            break
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(client.calls['query']) == 1
+    assert len(results) == 5
+    assert all(result is results[0] for result in results)
+    assert results[0].id == 1
+    assert Baz.baz_by_id.coalesce_stats() == {
+        'calls': 5,
+        'executed': 1,
+        'coalesced': 4,
+        'in_flight': 0,
+    }
+    assert Bar.record_by_id.coalesce_stats() is None
+
+
+def batch_get_responses():
+    requests = []
+
+    def batch_get_item(RequestItems):
+        requests.append(RequestItems)
+        keys = RequestItems['TestTable']['Keys']
+        # Leave the last key unprocessed on the first request
+        unprocessed = {}
+        if len(requests) == 1 and len(keys) > 1:
+            unprocessed = {'TestTable': {'Keys': keys[-1:]}}
+            keys = keys[:-1]
+        return {
+            'Responses': {'TestTable': [
+                dict(key, pk0={'S': '2022-11-24'}) for key in keys
+            ]},
+            'UnprocessedKeys': unprocessed,
+        }
+    return batch_get_item
+
+
+def test_prefetch_related_entities(fake_client):
+    test_bars = [
+        TestBar(test_id=1, bar_id=2, quantity=1),
+        TestBar(test_id=1, bar_id=3, quantity=1),
+        TestBar(test_id=1, bar_id=2, quantity=2),
+        TestBar(test_id=1, bar_id=None, quantity=2),
+    ]
+    client = fake_client(batch_get_item=batch_get_responses())
+    prefetch(test_bars, 'bar_id', 'test_id')
+
+    requests = client.calls['batch_get_item']
+    requested_keys = [
+        key['pk']['S']
+        for request in requests
+        for key in request['RequestItems']['TestTable']['Keys']
+    ]
+    assert sorted(requested_keys) == ['Bar#2', 'Bar#3', 'Bar#3', 'Test#1']
+    assert len(requests) == 3
+
+    assert test_bars[0].bar.id == 2
+    assert test_bars[1].bar.id == 3
+    assert test_bars[2].bar is test_bars[0].bar
+    assert test_bars[3].bar is None
+    assert all(test_bar.test.id == 1 for test_bar in test_bars)
+    assert isinstance(TestBar.bar, RelatedEntity)
+
+
+def test_prefetch_requires_entity_reference():
+    with pytest.raises(ValueError):
+        prefetch([TestBar(test_id=1, bar_id=2, quantity=1)], 'quantity')
+
+
+def test_access_pattern_filter_errors():
+    with pytest.raises(ValueError, match='quantity'):
+        TestItem.get_query_kwargs(
+            **TestItem.test_items_by_test.get_access_kwargs(
+                1,
+                quantity__gte=2,
+                quantity__lte=5
+            )
+        )
+
+    with pytest.raises(ValueError, match='gtt'):
+        TestItem.get_query_kwargs(
+            **TestItem.test_items_by_test.get_access_kwargs(1, quantity__gtt=5)
+        )
+
+    with pytest.raises(ValueError, match='cannot be used as a filter or key condition for test_items_by_test'):
+        TestItem.test_items_by_test.get_access_kwargs(1, id__gt='5')
+
+
+def test_access_pattern_reads_all_pages(fake_client):
+    item = {
+        'pk': {'S': 'Test#1'},
+        'sk': {'S': 'TestItem#1'},
+        'quantity': {'N': '6'},
+    }
+    client = fake_client(query=[
+        {'Items': [], 'LastEvaluatedKey': {'pk': {'S': 'Test#1'}}},
+        {'Items': [item], 'LastEvaluatedKey': {'pk': {'S': 'Test#1'}}},
+        {'Items': [item]},
+    ])
+    items = TestItem.test_items_by_test(1, quantity__gt=5)
+
+    assert len(client.calls['query']) == 3
+    assert [test_item.quantity for test_item in items] == [6, 6]
+
+    client = fake_client(query=[
+        {'Items': [], 'LastEvaluatedKey': {'pk': {'S': 'Bar#1'}}},
+        {'Items': []},
+    ])
+    assert Baz.baz_by_id(1) is None
+    assert len(client.calls['query']) == 2
+
+
+def test_single_flight_error_propagation():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    error = KeyError('missing')
+    errors = {}
+
+    def fail():
+        release.wait(5)
+        raise error
+
+    def run(name, fn):
+        try:
+            single_flight.do('key', fn)
+        except BaseException as e:
+            errors[name] = e
+
+    threads = [
+        threading.Thread(target=run, args=('leader', fail)),
+        threading.Thread(target=run, args=('waiter', fail)),
+    ]
+    threads[0].start()
+    while not single_flight.in_flight:
+        time.sleep(0.01)
+    threads[1].start()
+    while single_flight.coalesced < 1:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert errors['leader'] is error
+    assert isinstance(errors['waiter'], CoalescedCallError)
+    assert errors['waiter'].__cause__ is error
+
+
+def test_typed_gsi_keys(fake_client):
+    happened = datetime(2022, 11, 25, 18, 37, 11)
+    client = fake_client()
+    TestEvent(id=1, happened=happened).save()
+    TestEvent(id=2).save()
+
+    updates = client.calls['update_item']
+    values = updates[0]['ExpressionAttributeValues']
+    assert values[':pk1'] == {'S': '2022-11-25T18:37:11'}
+    assert values[':sk1'] == {'S': 'TestEvent#1'}
+    assert values[':happened'] == {'S': '2022-11-25T18:37:11'}
+    assert updates[1] == {
+        'TableName': 'TestTable',
+        'Key': {'pk': {'S': 'TestEvent#2'}, 'sk': {'S': '$'}},
+    }
+
+    query_kwargs = TestEvent.get_query_kwargs(
+        TestEvent.gsi2,
+        **TestEvent.events_by_time.get_access_kwargs(happened)
+    )
+    assert query_kwargs['KeyConditions']['pk1'] == {
+        'ComparisonOperator': 'EQ',
+        'AttributeValueList': [{'S': '2022-11-25T18:37:11'}]
+    }
+
+    access_kwargs = TestEvent.events_by_time.get_access_kwargs(
+        happened__between=(happened, datetime(2022, 11, 26))
+    )
+    query_kwargs = TestEvent.get_query_kwargs(TestEvent.gsi2, **access_kwargs)
+    assert query_kwargs['KeyConditions']['pk1'] == {
+        'ComparisonOperator': 'BETWEEN',
+        'AttributeValueList': [
+            {'S': '2022-11-25T18:37:11'},
+            {'S': '2022-11-26T00:00:00'}
+        ]
+    }
+
+
+def test_decimal_values():
+    assert Test.get_attribute_value(Decimal('1.10')) == {'N': '1.10'}
+    assert Test.get_attribute_value({Decimal('2'), 1}) == {'NS': ['1', '2']}
+    assert Test.get_attribute_value(True) == {'BOOL': True}
+
+    assert Attribute(Decimal).deserialize({'N': '1.10'}) == Decimal('1.10')
+    assert Attribute().deserialize({'N': '1.10'}) == Decimal('1.10')
+    assert Attribute().deserialize({'N': '3'}) == 3
+    assert TestDocument.meta.deserialize({'M': {'price': {'N': '0.10'}}}) == {
+        'price': Decimal('0.10')
+    }
+    assert TestDocument.tags.deserialize({'L': [{'N': '2.50'}]}) == [Decimal('2.50')]
+
+
+def test_untyped_attribute_round_trip():
+    attribute = Attribute()
+    for value in ([1, 'a', True, None], {'a': [1, {'b': False}]}, True, 5, 'x'):
+        assert attribute.deserialize(attribute.serialize(value)) == value
+    assert attribute.deserialize({'L': [{'N': '1'}]}) == [1]
+
+
+def test_datetime_string_operands():
+    assert TestEvent.events_by_time.get_access_kwargs(
+        happened__begins_with='2022-11'
+    ) == {
+        'pk1__begins_with': '2022-11',
+        'sk1__begins_with': 'TestEvent#'
+    }
+
+    query_kwargs = TestDocument.get_query_kwargs(updated__begins_with='2022')
+    assert query_kwargs['QueryFilter'] == {
+        'updated': {
+            'ComparisonOperator': 'BEGINS_WITH',
+            'AttributeValueList': [{'S': '2022'}]
+        }
+    }
+
+
+def test_prefetch_normalizes_reference_values(fake_client):
+    test_bars = [
+        TestBar(test_id=1, bar_id='2', quantity=1),
+        TestBar(test_id=1, bar_id=2, quantity=1),
+    ]
+    client = fake_client(batch_get_item=batch_get_responses())
+    prefetch(test_bars, 'bar_id')
+
+    assert client.calls['batch_get_item'] == [{'RequestItems': {
+        'TestTable': {'Keys': [{'pk': {'S': 'Bar#2'}, 'sk': {'S': '$'}}]}
+    }}]
+    assert test_bars[0].bar.id == 2
+    assert test_bars[1].bar is test_bars[0].bar
+
+
+def test_batch_get_gives_up_after_max_attempts(monkeypatch, fake_client):
+    monkeypatch.setattr(constants, 'BATCH_GET_MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(constants, 'BATCH_GET_BACKOFF', 0)
+    client = fake_client(
+        batch_get_item=lambda RequestItems: {
+            'Responses': {},
+            'UnprocessedKeys': RequestItems,
+        }
+    )
+    with pytest.raises(RuntimeError):
+        TestTable.batch_get([{'pk': {'S': 'Bar#2'}, 'sk': {'S': '$'}}])
+
+    assert len(client.calls['batch_get_item']) == 3